@@ -1,14 +1,90 @@
 import boto3
 import click
 import json
+import logging
 import os
-import ipaddress
 import csv
+import io
+import re
+import ipaddress
+import functools
+import itertools
+import socket
+import sys
+import collections
+import concurrent.futures
+import threading
+import time
 from datetime import datetime
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 出力はloggingで標準出力に書き出す（設定はmain()で行う）
+log = logging.getLogger(__name__)
+
+def log_buffered(entries):
+    """(ログレベル, メッセージ)の一覧を、同じレベルが続く部分ごとにまとめて出力"""
+    for level, group in itertools.groupby(entries, key=lambda entry: entry[0]):
+        log.log(level, "\n".join(message for _, message in group))
+
+# リソースIDのキャッシュ（名前 -> ID）
+CACHE_FILE = os.path.join(os.path.expanduser("~"), ".cache", "sg-ipset-lite", "ids.json")
+CACHE_TTL_SECONDS = 15 * 60
+_cache_lock = threading.Lock()
+
+# AWSクライアント共通設定
+# スロットリング対策にadaptiveリトライを使用し、並列処理（最大2スレッド）分の接続をkeepaliveで再利用する
+AWS_CLIENT_CONFIG = Config(
+    retries={'mode': 'adaptive', 'max_attempts': 10},
+    max_pool_connections=4,
+    tcp_keepalive=True,
+)
 
+# IP/CIDRの区切り文字（カンマ・セミコロン・空白）
+IP_SEPARATOR_RE = re.compile(r'[,;\s]+')
+
+@functools.lru_cache(maxsize=1)
 def load_config():
-    with open("config.json", "r", encoding="utf-8") as f:
-        return json.load(f)
+    """config.jsonを読み込み（結果はキャッシュし、2回目以降はファイルを読まない）"""
+    # バイト列のまま読み込み、orjsonがあれば高速にデコードする
+    with open("config.json", "rb") as f:
+        data = f.read()
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def _load_cache():
+    """キャッシュファイルを読み込み（存在しない・壊れている場合は空）"""
+    try:
+        with open(CACHE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _cache_get(key):
+    """有効期限内のキャッシュ値を取得"""
+    entry = _load_cache().get(key)
+    if entry and entry.get("expires", 0) > time.time():
+        return entry.get("value")
+    return None
+
+def _cache_set(key, value, ttl=CACHE_TTL_SECONDS):
+    """キャッシュ値を保存（保存に失敗しても処理は継続）"""
+    # SG・WAFの取得を並列に行うため、読み込みから書き込みまでを排他する
+    with _cache_lock:
+        cache = _load_cache()
+        cache[key] = {"value": value, "expires": time.time() + ttl}
+        try:
+            os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+            with open(CACHE_FILE, "w", encoding="utf-8") as f:
+                json.dump(cache, f)
+        except OSError as e:
+            log.warning(f"警告: キャッシュ保存エラー: {e}")
 
 def create_backup_directory():
     """バックアップディレクトリを作成"""
@@ -17,228 +93,612 @@ def create_backup_directory():
         os.makedirs(backup_dir)
     return backup_dir
 
-def backup_security_group_to_csv(ec2_client, sg_id, sg_name, backup_dir):
-    """セキュリティグループの許可IP一覧をCSVにバックアップ"""
+def backup_security_group_to_csv(ec2_client, sg_id, sg_name, backup_dir, timestamp, sg=None):
+    """セキュリティグループの許可IP一覧をCSVにバックアップ（取得済みのsgがあれば再取得しない）"""
     try:
-        sg_response = ec2_client.describe_security_groups(GroupIds=[sg_id])
-        sg = sg_response["SecurityGroups"][0]
+        if sg is None:
+            sg_response = ec2_client.describe_security_groups(GroupIds=[sg_id])
+            sg = sg_response["SecurityGroups"][0]
         
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         filename = f"backup_{timestamp}_sg_{sg_name}.csv"
         filepath = os.path.join(backup_dir, filename)
         
-        with open(filepath, 'w', newline='', encoding='utf-8') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(['プロトコル', 'ポート範囲', 'IP/CIDR', '説明', 'セキュリティグループ名', 'セキュリティグループID', 'バックアップ日時'])
-            
-            for perm in sg["IpPermissions"]:
-                if perm.get('IpRanges'):
-                    for ip_range in perm.get('IpRanges', []):
-                        protocol = perm.get('IpProtocol', 'all')
-                        from_port = perm.get('FromPort', 'all')
-                        to_port = perm.get('ToPort', 'all')
-                        cidr = ip_range['CidrIp']
-                        description = ip_range.get('Description', '')
-                        
-                        writer.writerow([
-                            protocol,
-                            f"{from_port}-{to_port}",
-                            cidr,
-                            description,
-                            sg_name,
-                            sg_id,
-                            timestamp
-                        ])
+        rows = [
+            [
+                perm.get('IpProtocol', 'all'),
+                f"{perm.get('FromPort', 'all')}-{perm.get('ToPort', 'all')}",
+                ip_range['CidrIp'],
+                ip_range.get('Description', ''),
+                sg_name,
+                sg_id,
+                timestamp
+            ]
+            for perm in sg["IpPermissions"]
+            for ip_range in perm.get('IpRanges', [])
+        ]
         
-        print(f"  [バックアップ] {filepath}")
-        return filepath
-    except Exception as e:
-        print(f"  [バックアップ失敗] セキュリティグループ: {e}")
-        return None
+        # メモリ上でCSVを組み立て、1回の書き込みで保存する（書き込んだバイト数をそのまま返す）
+        csvfile = io.StringIO(newline='')
+        writer = csv.writer(csvfile)
+        writer.writerow(['プロトコル', 'ポート範囲', 'IP/CIDR', '説明', 'セキュリティグループ名', 'セキュリティグループID', 'バックアップ日時'])
+        writer.writerows(rows)
+        data = csvfile.getvalue().encode('utf-8')
+        with open(filepath, 'wb') as f:
+            f.write(data)
+        
+        log.info(f"  [バックアップ] {filepath}")
+        return filepath, len(data)
+    except (BotoCoreError, ClientError, OSError) as e:
+        log.error(f"  [バックアップ失敗] セキュリティグループ: {e}")
+        return None, None
 
-def backup_waf_ipset_to_csv(wafv2_client, ipset_name, ipset_id, backup_dir):
-    """WAF IPSetの許可IP一覧をCSVにバックアップ"""
+def backup_waf_ipset_to_csv(wafv2_client, ipset_name, ipset_id, backup_dir, timestamp, ipset=None):
+    """WAF IPSetの許可IP一覧をCSVにバックアップ（取得済みのipsetがあれば再取得しない）"""
     try:
-        ipset = wafv2_client.get_ip_set(Name=ipset_name, Id=ipset_id, Scope="REGIONAL")
+        if ipset is None:
+            ipset = wafv2_client.get_ip_set(Name=ipset_name, Id=ipset_id, Scope="REGIONAL")
         
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         filename = f"backup_{timestamp}_waf_{ipset_name}.csv"
         filepath = os.path.join(backup_dir, filename)
         
-        with open(filepath, 'w', newline='', encoding='utf-8') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(['IP/CIDR', 'WAF IPSet名', 'WAF IPSet ID', 'バックアップ日時'])
-            
-            for ip in sorted(ipset["IPSet"]["Addresses"]):
-                writer.writerow([
-                    ip,
-                    ipset_name,
-                    ipset_id,
-                    timestamp
-                ])
+        # メモリ上でCSVを組み立て、1回の書き込みで保存する（書き込んだバイト数をそのまま返す）
+        csvfile = io.StringIO(newline='')
+        writer = csv.writer(csvfile)
+        writer.writerow(['IP/CIDR', 'WAF IPSet名', 'WAF IPSet ID', 'バックアップ日時'])
+        # バックアップは並び順に意味がないため、ソートせずAWSから取得した順に書き出す
+        writer.writerows([ip, ipset_name, ipset_id, timestamp] for ip in ipset["IPSet"]["Addresses"])
+        data = csvfile.getvalue().encode('utf-8')
+        with open(filepath, 'wb') as f:
+            f.write(data)
         
-        print(f"  [バックアップ] {filepath}")
-        return filepath
-    except Exception as e:
-        print(f"  [バックアップ失敗] WAF IPSet: {e}")
-        return None
+        log.info(f"  [バックアップ] {filepath}")
+        return filepath, len(data)
+    except (BotoCoreError, ClientError, OSError) as e:
+        log.error(f"  [バックアップ失敗] WAF IPSet: {e}")
+        return None, None
 
-def create_backup_summary(backup_dir, sg_backup_path, waf_backup_path, sg_name, waf_ipset_name):
+def create_backup_summary(backup_dir, sg_backup_path, sg_backup_size, waf_backup_path, waf_backup_size, sg_name, waf_ipset_name, run_time):
     """バックアップサマリーファイルを作成"""
     try:
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        timestamp = run_time.strftime("%Y%m%d_%H%M%S")
         summary_filename = f"backup_summary_{timestamp}.txt"
         summary_filepath = os.path.join(backup_dir, summary_filename)
         
         with open(summary_filepath, 'w', encoding='utf-8') as f:
-            f.write(f"バックアップ実行日時: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+            f.write(f"バックアップ実行日時: {run_time.strftime('%Y-%m-%d %H:%M:%S')}\n")
             f.write("=" * 50 + "\n\n")
             
             if sg_backup_path:
                 f.write(f"セキュリティグループ: {sg_name}\n")
                 f.write(f"バックアップファイル: {os.path.basename(sg_backup_path)}\n")
-                f.write(f"ファイルサイズ: {os.path.getsize(sg_backup_path)} bytes\n\n")
+                f.write(f"ファイルサイズ: {sg_backup_size} bytes\n\n")
             else:
                 f.write(f"セキュリティグループ: {sg_name} - バックアップ失敗\n\n")
             
             if waf_backup_path:
                 f.write(f"WAF IPSet: {waf_ipset_name}\n")
                 f.write(f"バックアップファイル: {os.path.basename(waf_backup_path)}\n")
-                f.write(f"ファイルサイズ: {os.path.getsize(waf_backup_path)} bytes\n\n")
+                f.write(f"ファイルサイズ: {waf_backup_size} bytes\n\n")
             else:
                 f.write(f"WAF IPSet: {waf_ipset_name} - バックアップ失敗\n\n")
         
-        print(f"  [サマリー] {summary_filepath}")
+        log.info(f"  [サマリー] {summary_filepath}")
         return summary_filepath
-    except Exception as e:
-        print(f"  [サマリー作成失敗] {e}")
+    except OSError as e:
+        log.error(f"  [サマリー作成失敗] {e}")
         return None
 
+def create_backups(ec2_client, wafv2_client, sg_id, sg_name, waf_ipset_id, waf_ipset_name, sg_available, waf_available, sg=None, ipset=None):
+    """SG・WAF IPSetのバックアップとサマリーを作成（取得済みのsg・ipsetがあれば再取得しない）"""
+    log.info("\n=== バックアップ実行 ===")
+    backup_dir = create_backup_directory()
+    # 同じ実行のバックアップファイル名を揃えるため、日時は1回だけ取得する
+    backup_time = datetime.now()
+    backup_timestamp = backup_time.strftime("%Y%m%d_%H%M%S")
+    
+    sg_backup_path, sg_backup_size = None, None
+    waf_backup_path, waf_backup_size = None, None
+    
+    if sg_available:
+        log.info(f"[SG] {sg_name} のバックアップを作成中...")
+        sg_backup_path, sg_backup_size = backup_security_group_to_csv(ec2_client, sg_id, sg_name, backup_dir, backup_timestamp, sg)
+    else:
+        log.info(f"[SG] {sg_name} のバックアップをスキップします（見つかりません）")
+    
+    if waf_available:
+        log.info(f"[WAF] {waf_ipset_name} のバックアップを作成中...")
+        waf_backup_path, waf_backup_size = backup_waf_ipset_to_csv(wafv2_client, waf_ipset_name, waf_ipset_id, backup_dir, backup_timestamp, ipset)
+    else:
+        log.info(f"[WAF] {waf_ipset_name} のバックアップをスキップします（見つかりません）")
+    
+    # バックアップサマリーを作成
+    create_backup_summary(backup_dir, sg_backup_path, sg_backup_size, waf_backup_path, waf_backup_size, sg_name, waf_ipset_name, backup_time)
+    log.info("バックアップ完了")
+
 def parse_ip_list(ip_str):
-    """IPアドレスまたはCIDRレンジを解析（単一IPのみ対応）"""
+    """IPアドレスまたはCIDRレンジを解析・検証し、正規形のリストを返す（単一IPのみ対応）
+    
+    不正な値があった時点でValueErrorを送出する。
+    """
     if not ip_str:
         return []
     
-    # カンマやスペースで区切られている場合はエラー
-    if ',' in ip_str or ' ' in ip_str:
+    tokens = [token for token in IP_SEPARATOR_RE.split(ip_str) if token]
+    
+    # カンマ・セミコロン・空白などで区切られている場合はエラー
+    if len(tokens) > 1:
         raise ValueError("複数IPの指定はサポートされていません。単一IPのみ指定してください。")
     
-    ip = ip_str.strip()
-    if ip:
-        # CIDR表記がない場合は/32を追加
-        if '/' not in ip:
-            ip = f"{ip}/32"
-        return [ip]
+    ip_list = []
+    for token in tokens:
+        if not validate_cidr(token):
+            raise ValueError(f"無効なCIDR表記: {token}")
+        # 正規形に揃える（プレフィックスがない場合はIPv4なら/32、IPv6なら/128）
+        ip_list.append(canonicalize_cidr(token))
     
-    return []
-
-def normalize_cidr(cidr_str):
-    """CIDR表記を正規化（/32がない場合は追加）"""
-    if '/' not in cidr_str:
-        return f"{cidr_str}/32"
-    return cidr_str
+    # 重複を除去（入力順は保持）
+    return list(dict.fromkeys(ip_list))
 
+@functools.lru_cache(maxsize=1024)
 def validate_cidr(cidr_str):
     """CIDR表記の妥当性をチェック"""
+    ip, sep, prefix = cidr_str.partition('/')
+    # IPv6の最大長（39文字）を超える場合は解析せずに不正とする
+    if len(ip) > 39:
+        return False
+    
+    # ':'の有無でIPv4/IPv6を判定し、該当する方式のみで解析する
+    is_v6 = ':' in ip
     try:
-        ipaddress.ip_network(cidr_str, strict=False)
-        return True
-    except ValueError:
+        if is_v6:
+            socket.inet_pton(socket.AF_INET6, ip)
+            max_prefix = 128
+        else:
+            socket.inet_pton(socket.AF_INET, ip)
+            max_prefix = 32
+    except OSError:
         return False
+    
+    if not sep:
+        return True
+    return prefix.isascii() and prefix.isdigit() and int(prefix) <= max_prefix
 
-def get_security_group_id_by_name(ec2_client, sg_name):
-    """セキュリティグループ名からIDを取得"""
+@functools.lru_cache(maxsize=1024)
+def canonicalize_cidr(cidr_str):
+    """CIDR表記を正規形に変換（例: 10.0.0.1 -> 10.0.0.1/32、2001:DB8::1 -> 2001:db8::1/128）
+    
+    プレフィックスがない場合のデフォルト（IPv4は/32、IPv6は/128）はipaddressに任せる。
+    """
+    return ipaddress.ip_network(cidr_str, strict=False).with_prefixlen
+
+def get_security_group_id_by_name(ec2_client, sg_name, refresh_cache=False):
+    """セキュリティグループ名からIDを取得（キャッシュ有効期限内はAPIを呼ばない）"""
+    cache_key = f"sg:{ec2_client.meta.region_name}:{sg_name}"
+    if not refresh_cache:
+        cached_id = _cache_get(cache_key)
+        if cached_id:
+            return cached_id
+    
     try:
-        response = ec2_client.describe_security_groups(
+        # NextTokenが返された場合も取りこぼさないようページネーターで検索し、見つかった時点で終了
+        paginator = ec2_client.get_paginator('describe_security_groups')
+        pages = paginator.paginate(
             Filters=[
                 {'Name': 'group-name', 'Values': [sg_name]}
             ]
         )
-        if response['SecurityGroups']:
-            return response['SecurityGroups'][0]['GroupId']
-        else:
-            return None
-    except Exception as e:
-        print(f"警告: セキュリティグループ取得エラー: {e}")
+        for page in pages:
+            if page['SecurityGroups']:
+                sg_id = page['SecurityGroups'][0]['GroupId']
+                _cache_set(cache_key, sg_id)
+                return sg_id
+        return None
+    except (BotoCoreError, ClientError) as e:
+        log.warning(f"警告: セキュリティグループ取得エラー: {e}")
         return None
 
-def get_waf_ipset_id_by_name(wafv2_client, ipset_name):
-    """WAF IPSet名からIDを取得"""
+def get_waf_ipset_id_by_name(wafv2_client, ipset_name, refresh_cache=False):
+    """WAF IPSet名からIDを取得（キャッシュ有効期限内はAPIを呼ばない）"""
+    cache_key = f"waf:{wafv2_client.meta.region_name}:{ipset_name}"
+    if not refresh_cache:
+        cached_id = _cache_get(cache_key)
+        if cached_id:
+            return cached_id
+    
     try:
-        response = wafv2_client.list_ip_sets(Scope='REGIONAL')
-        for ipset in response['IPSets']:
-            if ipset['Name'] == ipset_name:
-                return ipset['Id']
-        return None
-    except Exception as e:
-        print(f"警告: WAF IPSet取得エラー: {e}")
+        # list_ip_setsにはページネーターがないため、NextMarkerで全ページを検索する
+        # （見つかった時点で終了）
+        params = {'Scope': 'REGIONAL', 'Limit': 100}
+        while True:
+            response = wafv2_client.list_ip_sets(**params)
+            for ipset in response['IPSets']:
+                if ipset['Name'] == ipset_name:
+                    _cache_set(cache_key, ipset['Id'])
+                    return ipset['Id']
+            next_marker = response.get('NextMarker')
+            if not response['IPSets'] or not next_marker:
+                return None
+            params['NextMarker'] = next_marker
+    except (BotoCoreError, ClientError) as e:
+        log.warning(f"警告: WAF IPSet取得エラー: {e}")
         return None
 
-def get_ip_permissions_for_cidr(sg_permissions, target_cidr):
-    """指定CIDRに関連するすべての権限を取得"""
-    permissions = []
+def build_cidr_index(sg_permissions):
+    """CIDRごとに関連する権限の一覧を作成（正規形のCIDR -> 権限リスト）"""
+    index = collections.defaultdict(list)
+    
+    for perm in sg_permissions:
+        for cidr in {canonicalize_cidr(ip_range['CidrIp']) for ip_range in perm.get('IpRanges', [])}:
+            index[cidr].append(perm)
+    
+    return index
+
+def build_address_map(addresses):
+    """AWS上のアドレス一覧から正規形 -> AWS上の表記 の対応を作成
+    
+    件数が多いためcanonicalize_cidrのキャッシュは使わず、1件につき1回だけ解析する。
+    """
+    return {ipaddress.ip_network(address, strict=False).with_prefixlen: address for address in addresses}
+
+def build_change_plan(before_cidrs, after_cidrs):
+    """SG・WAF共通の変更計画を作成
+    
+    remove: 削除するCIDR、add: 追加するCIDR、mapping: 変更前CIDR -> 変更後CIDR の対応（削除モードでは空）。
+    変更前後で同じCIDRは変更対象から除外する。
+    """
+    before_set = set(before_cidrs)
+    after_set = set(after_cidrs)
+    return {
+        'remove': [cidr for cidr in before_cidrs if cidr not in after_set],
+        'add': [cidr for cidr in after_cidrs if cidr not in before_set],
+        'mapping': {old: new for old, new in zip(before_cidrs, after_cidrs) if old != new},
+    }
+
+def build_sg_permission_changes(sg_permissions, before_cidrs, cidr_mapping):
+    """変更前CIDRの削除用・変更後CIDRの追加用のIpPermissionsをまとめて作成
+    
+    権限を(プロトコル, 開始ポート, 終了ポート)ごとにまとめ、対象CIDRのIpRangeのみを含める。
+    cidr_mapping（変更前CIDR -> 変更後CIDR）に含まれるIpRangeは、1件につき1件の追加用IpRangeに変換する。
+    CIDRは正規形で比較し、削除用のIpRangeにはAWS上の表記をそのまま使用する。
+    同じ権限内で重複するCIDRは1件にまとめる（重複があるとAPIがエラーになるため）。
+    同じ権限に既に存在する変更後CIDRは追加しない（1件でも重複があると追加全体が失敗するため）。
+    """
+    before_set = set(before_cidrs)
+    grouped = {}
+    existing = {}
     
     for perm in sg_permissions:
+        key = (perm.get('IpProtocol'), perm.get('FromPort'), perm.get('ToPort'))
         for ip_range in perm.get('IpRanges', []):
-            if ip_range['CidrIp'] == target_cidr:
-                permissions.append(perm)
-                break
+            cidr = canonicalize_cidr(ip_range['CidrIp'])
+            existing.setdefault(key, set()).add(cidr)
+            if cidr in before_set:
+                grouped.setdefault(key, {}).setdefault(ip_range['CidrIp'], ip_range)
+    
+    all_remove = []
+    all_add = []
+    for (protocol, from_port, to_port), ranges_by_cidr in grouped.items():
+        ranges = list(ranges_by_cidr.values())
+        base = {'IpProtocol': protocol}
+        if from_port is not None:
+            base['FromPort'] = from_port
+        if to_port is not None:
+            base['ToPort'] = to_port
+        
+        all_remove.append({**base, 'IpRanges': ranges})
+        
+        # 新しいCIDR用のIpRangeを作成（元のDescriptionを保持）
+        new_ranges = {}
+        existing_cidrs = existing[(protocol, from_port, to_port)]
+        for ip_range in ranges:
+            new_cidr = cidr_mapping.get(canonicalize_cidr(ip_range['CidrIp']))
+            if new_cidr is None or new_cidr in new_ranges or new_cidr in existing_cidrs:
+                continue
+            new_range = {'CidrIp': new_cidr}
+            if 'Description' in ip_range:
+                new_range['Description'] = ip_range['Description']
+            new_ranges[new_cidr] = new_range
+        if new_ranges:
+            all_add.append({**base, 'IpRanges': list(new_ranges.values())})
     
-    return permissions
+    return all_remove, all_add
 
-def confirm_execution(before_cidrs, after_cidrs, sg_name, waf_ipset_name, sg_available, waf_available, sg_before_exists, waf_before_exists):
-    """実行前の確認プロンプト"""
-    print("\n=== 変更内容の確認 ===")
+def confirm_execution(before_cidrs, after_cidrs, sg_name, waf_ipset_name, sg_available, waf_available, sg_before_exists, waf_before_exists, assume_yes=False):
+    """実行前の確認プロンプト（assume_yesの場合は変更内容の表示のみ）"""
+    log.info("\n=== 変更内容の確認 ===")
     
     if sg_available:
-        print(f"セキュリティグループ: {sg_name} ✓")
+        log.info(f"セキュリティグループ: {sg_name} ✓")
     else:
-        print(f"セキュリティグループ: {sg_name} ✗ (見つかりません)")
+        log.info(f"セキュリティグループ: {sg_name} ✗ (見つかりません)")
     
     if waf_available:
-        print(f"WAF IPSet: {waf_ipset_name} ✓")
+        log.info(f"WAF IPSet: {waf_ipset_name} ✓")
     else:
-        print(f"WAF IPSet: {waf_ipset_name} ✗ (見つかりません)")
+        log.info(f"WAF IPSet: {waf_ipset_name} ✗ (見つかりません)")
     
-    print()
+    log.info("")
     
     if before_cidrs:
-        print("【削除するIP/CIDR】")
+        log.info("【削除するIP/CIDR】")
         for cidr in before_cidrs:
             sg_marker = " ✓" if sg_before_exists.get(cidr, False) else " ✗"
             waf_marker = " ✓" if waf_before_exists.get(cidr, False) else " ✗"
-            print(f"  - {cidr} (SG{sg_marker}, WAF{waf_marker})")
+            log.info(f"  - {cidr} (SG{sg_marker}, WAF{waf_marker})")
     else:
-        print("【削除するIP/CIDR】なし")
+        log.info("【削除するIP/CIDR】なし")
     
-    print()
+    log.info("")
     
     if after_cidrs:
-        print("【追加するIP/CIDR】")
+        log.info("【追加するIP/CIDR】")
         for cidr in after_cidrs:
             sg_marker = " ✓" if sg_available else " ✗"
             waf_marker = " ✓" if waf_available else " ✗"
-            print(f"  + {cidr} (SG{sg_marker}, WAF{waf_marker})")
+            log.info(f"  + {cidr} (SG{sg_marker}, WAF{waf_marker})")
+    else:
+        log.info("【追加するIP/CIDR】なし")
+    
+    log.info("\n" + "="*50)
+    
+    if assume_yes:
+        return True
+    
+    try:
+        return click.confirm("上記の変更を実行しますか？", default=False)
+    except click.Abort:
+        # 標準入力が閉じられている場合などは実行しない
+        log.info("")
+        return False
+
+def apply_sg_permission_changes(sg_permissions, all_remove, all_add):
+    """revoke/authorizeの結果をローカルの権限一覧に反映した一覧を作成"""
+    def perm_key(perm):
+        return (perm.get('IpProtocol'), perm.get('FromPort'), perm.get('ToPort'))
+    
+    removed = {}
+    for perm in all_remove:
+        removed.setdefault(perm_key(perm), set()).update(ip_range['CidrIp'] for ip_range in perm['IpRanges'])
+    added = {perm_key(perm): perm for perm in all_add}
+    
+    updated_permissions = []
+    for perm in sg_permissions:
+        key = perm_key(perm)
+        new_perm = dict(perm)
+        new_perm['IpRanges'] = [
+            ip_range for ip_range in perm.get('IpRanges', [])
+            if ip_range['CidrIp'] not in removed.get(key, ())
+        ]
+        if key in added:
+            new_perm['IpRanges'] += added.pop(key)['IpRanges']
+        updated_permissions.append(new_perm)
+    updated_permissions.extend(added.values())
+    
+    return updated_permissions
+
+def fetch_security_group(ec2_client, sg_id, sg_name):
+    """セキュリティグループの現在の情報を取得
+    
+    キャッシュしたIDが古い場合はIDを再取得して1回だけ再試行する。
+    (セキュリティグループID, セキュリティグループ情報)を返す（見つからない場合は(None, None)）。
+    """
+    try:
+        sg_response = ec2_client.describe_security_groups(GroupIds=[sg_id])
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "InvalidGroup.NotFound":
+            raise
+        sg_id = get_security_group_id_by_name(ec2_client, sg_name, refresh_cache=True)
+        if sg_id is None:
+            return None, None
+        sg_response = ec2_client.describe_security_groups(GroupIds=[sg_id])
+    return sg_id, sg_response["SecurityGroups"][0]
+
+def fetch_waf_ipset(wafv2_client, ipset_name, ipset_id):
+    """WAF IPSetの現在の情報を取得
+    
+    キャッシュしたIDが古い場合はIDを再取得して1回だけ再試行する。
+    (WAF IPSet ID, IPSet情報)を返す（見つからない場合は(None, None)）。
+    """
+    try:
+        ipset = wafv2_client.get_ip_set(Name=ipset_name, Id=ipset_id, Scope="REGIONAL")
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "WAFNonexistentItemException":
+            raise
+        ipset_id = get_waf_ipset_id_by_name(wafv2_client, ipset_name, refresh_cache=True)
+        if ipset_id is None:
+            return None, None
+        ipset = wafv2_client.get_ip_set(Name=ipset_name, Id=ipset_id, Scope="REGIONAL")
+    return ipset_id, ipset
+
+def update_security_group(ec2_client, sg_id, sg_name, operation_mode, plan, output, sg=None, dry_run=False):
+    """セキュリティグループの許可IPを変更計画に従って更新（出力は(ログレベル, メッセージ)としてoutputに蓄積）
+    
+    取得済みのsgがあれば再取得しない。更新後の権限一覧を返す（更新に失敗した場合はNone）。
+    dry_runの場合はrevoke/authorizeを呼ばず、送信する内容のみ出力する。
+    """
+    before_cidrs = plan['remove']
+    after_cidrs = plan['add']
+    output.append((logging.INFO, f"\n[SG] {sg_name} ({sg_id}) の許可IPを更新します"))
+    
+    # 現在のSG情報を取得（取得済みの場合は再利用）
+    if sg is None:
+        sg_response = ec2_client.describe_security_groups(GroupIds=[sg_id])
+        sg = sg_response["SecurityGroups"][0]
+    
+    if operation_mode == "削除":
+        # 削除モード: 指定CIDRをすべて削除対象とする
+        sg_before_targets = before_cidrs
     else:
-        print("【追加するIP/CIDR】なし")
+        # IP変更モード: 存在するCIDRのみ変更対象とする（権限一覧を1回走査した索引で判定）
+        cidr_index = build_cidr_index(sg["IpPermissions"])
+        sg_before_targets = [cidr for cidr in before_cidrs if cidr in cidr_index]
+    
+    # 削除・追加する権限をまとめて作成（API呼び出しはそれぞれ1回）
+    all_remove, all_add = build_sg_permission_changes(sg["IpPermissions"], sg_before_targets, plan['mapping'])
+    
+    if not all_remove:
+        if operation_mode == "削除":
+            for cidr in before_cidrs:
+                output.append((logging.INFO, f"  削除対象なし: {cidr}"))
+        else:
+            output.append((logging.INFO, "  変更対象が存在しません"))
+    elif dry_run:
+        output.append((logging.INFO, "  [ドライラン] revoke_security_group_ingress:"))
+        output.append((logging.INFO, json.dumps(all_remove, ensure_ascii=False, indent=2)))
+        if all_add:
+            output.append((logging.INFO, "  [ドライラン] authorize_security_group_ingress:"))
+            output.append((logging.INFO, json.dumps(all_add, ensure_ascii=False, indent=2)))
+    else:
+        failed = False
+        
+        # 1. 変更前CIDRのすべての権限を削除
+        try:
+            ec2_client.revoke_security_group_ingress(
+                GroupId=sg_id,
+                IpPermissions=all_remove
+            )
+            remove_index = build_cidr_index(all_remove)
+            for cidr in sg_before_targets:
+                count = len(remove_index.get(cidr, ()))
+                if count:
+                    output.append((logging.INFO, f"  削除: {cidr} (プロトコル: {count}個)"))
+                else:
+                    output.append((logging.INFO, f"  削除対象なし: {cidr}"))
+        except ClientError as e:
+            # 削除はまとめて1回で行うため、一部の権限が見つからない場合（InvalidPermission.NotFound）も含めて何も削除されていない
+            failed = True
+            output.append((logging.ERROR, f"  削除失敗: {e}"))
+        
+        # 2. 変更後CIDRを追加（削除した権限と同じ権限を新しいCIDRで追加）
+        # 削除に失敗した場合は、変更前・変更後の両方が許可された状態にならないよう追加しない
+        add_index = build_cidr_index(all_add)
+        if failed:
+            if all_add:
+                output.append((logging.ERROR, "  削除に失敗したため、追加は行いません"))
+        elif all_add:
+            try:
+                ec2_client.authorize_security_group_ingress(
+                    GroupId=sg_id,
+                    IpPermissions=all_add
+                )
+                for cidr in after_cidrs:
+                    count = len(add_index.get(cidr, ()))
+                    if count:
+                        output.append((logging.INFO, f"  追加: {cidr} (プロトコル: {count}個)"))
+            except ClientError as e:
+                # 追加はまとめて1回で行うため、重複エラーでも何も追加されていない
+                failed = True
+                output.append((logging.ERROR, f"  追加失敗: {e}"))
+        if not failed:
+            for cidr in after_cidrs:
+                if cidr not in add_index:
+                    output.append((logging.INFO, f"  追加済み: {cidr} (既存の権限に登録済みのためスキップ)"))
+        
+        # 失敗した場合は実際の状態を確認するため、呼び出し元で再取得させる
+        if failed:
+            return None
+        return apply_sg_permission_changes(sg["IpPermissions"], all_remove, all_add)
     
-    print("\n" + "="*50)
+    return sg["IpPermissions"]
+
+def update_waf_ipset(wafv2_client, waf_ipset_name, waf_ipset_id, operation_mode, plan, output, ipset=None, address_map=None, dry_run=False):
+    """WAF IPSetの許可IPを変更計画に従って更新（出力は(ログレベル, メッセージ)としてoutputに蓄積）
+    
+    取得済みのipset（とその正規形の対応address_map）があれば最初の更新に使用する（LockTokenが古い場合は再取得して再試行）。
+    更新後のアドレス（ソート済みリスト）と正規形の対応を返す（失敗した場合は(None, None)）。
+    dry_runの場合はupdate_ip_setを呼ばず、送信する内容のみ出力する。
+    """
+    before_cidrs = plan['remove']
+    after_cidrs = plan['add']
+    output.append((logging.INFO, f"\n[WAF] {waf_ipset_name} ({waf_ipset_id}) のIPSetを更新します"))
+    
+    failure_label = "WAF削除失敗" if operation_mode == "削除" else "WAF更新失敗"
+    
+    # 他の更新と競合した場合（WAFOptimisticLockException）はLockTokenを取り直して1回だけ再試行
+    for attempt in range(2):
+        try:
+            if ipset is None or attempt > 0:
+                ipset = wafv2_client.get_ip_set(Name=waf_ipset_name, Id=waf_ipset_id, Scope="REGIONAL")
+                address_map = None
+            # 表記ゆれを吸収するため正規形で比較する（正規形 -> AWS上の表記）
+            if address_map is None:
+                address_map = build_address_map(ipset["IPSet"]["Addresses"])
+            current_by_cidr = address_map
+            current_addresses = set(ipset["IPSet"]["Addresses"])
+            
+            if operation_mode == "削除":
+                # 削除モード: 指定CIDRをすべて削除対象とする
+                waf_before_targets = before_cidrs
+            else:
+                # IP変更モード: WAFに存在するCIDRのみ変更対象とする
+                waf_before_targets = [cidr for cidr in before_cidrs if cidr in current_by_cidr]
+                if not waf_before_targets:
+                    output.append((logging.INFO, "  変更対象が存在しません"))
+                    return sorted(current_addresses), current_by_cidr
+            
+            # 変更前CIDRの削除と変更後CIDRの追加を集合演算でまとめて計算
+            remove_set = set(waf_before_targets)
+            updated_by_cidr = {cidr: address for cidr, address in current_by_cidr.items() if cidr not in remove_set}
+            for cidr in after_cidrs:
+                updated_by_cidr.setdefault(cidr, cidr)
+            addresses = set(updated_by_cidr.values())
+            
+            # 変更がない場合は更新APIを呼ばない
+            if addresses == current_addresses:
+                updated = None
+                break
+            
+            if dry_run:
+                output.append((logging.INFO, "  [ドライラン] update_ip_set Addresses:"))
+                output.append((logging.INFO, json.dumps(sorted(addresses), indent=2)))
+                return sorted(current_addresses), current_by_cidr
+            
+            # 反映
+            updated = wafv2_client.update_ip_set(
+                Name=waf_ipset_name,
+                Id=waf_ipset_id,
+                Scope="REGIONAL",
+                Addresses=list(addresses),
+                LockToken=ipset["LockToken"]
+            )
+            break
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "WAFOptimisticLockException" and attempt == 0:
+                output.append((logging.WARNING, "  他の更新と競合したため、最新の状態を取得して再試行します"))
+                continue
+            output.append((logging.ERROR, f"  {failure_label}: {e}"))
+            return None, None
+        except BotoCoreError as e:
+            output.append((logging.ERROR, f"  {failure_label}: {e}"))
+            return None, None
     
-    while True:
-        response = input("上記の変更を実行しますか？ (yes/no): ").strip().lower()
-        if response in ['yes', 'y']:
-            return True
-        elif response in ['no', 'n']:
-            return False
+    for cidr in waf_before_targets:
+        if cidr in current_by_cidr:
+            output.append((logging.INFO, f"  削除: {cidr}"))
         else:
-            print("'yes' または 'no' で回答してください。")
+            output.append((logging.INFO, f"  削除対象なし: {cidr}"))
+    for cidr in after_cidrs:
+        output.append((logging.INFO, f"  追加: {cidr}"))
+    
+    if updated is None:
+        output.append((logging.INFO, "  変更がないため更新をスキップします"))
+        return sorted(current_addresses), current_by_cidr
+    
+    # ソートは1回だけ行い、一覧表示でも再利用する
+    waf_addresses = sorted(addresses)
+    output.append((logging.INFO, f"  許可IPセット: {waf_addresses}"))
+    
+    return waf_addresses, updated_by_cidr
 
 @click.command()
 @click.option('--before', '-b', help='変更前IP/CIDR（削除対象）', required=False)
 @click.option('--after', '-a', help='変更後IP/CIDR（追加対象）', required=False)
 @click.option('--delete', help='削除するIP/CIDR', required=False)
 @click.option('--no-backup', is_flag=True, help='バックアップをスキップする')
-def main(before, after, delete, no_backup):
+@click.option('--refresh-cache', is_flag=True, help='キャッシュを使わずにSG/WAF IPSetのIDを再取得する')
+@click.option('--yes', '-y', 'assume_yes', is_flag=True, help='確認プロンプトを表示せずに実行する')
+@click.option('--dry-run', is_flag=True, help='現在の状態を取得して変更内容と送信内容のみ表示する（確認プロンプト・バックアップ・変更は行わない）')
+def main(before, after, delete, no_backup, refresh_cache, assume_yes, dry_run):
     """
     指定したSGとWAF IPSetの許可IPを更新します。
     
@@ -248,27 +708,36 @@ def main(before, after, delete, no_backup):
     
     IPアドレスまたはCIDR表記（例: 192.168.1.0/24）に対応しています。
     """
-    # 引数の検証
-    if delete:
-        # 削除モード
-        if before or after:
-            print("エラー: --deleteオプション使用時は、--before、--afterオプションは使用できません。")
-            return
-        before_cidrs = parse_ip_list(delete)
-        after_cidrs = []
-        operation_mode = "削除"
-    elif before and after:
-        # IP変更モード
+    # ライブラリ（botocore等）のINFOログは出さず、このツールの出力のみINFOで表示する
+    logging.basicConfig(level=logging.WARNING, format='%(message)s', stream=sys.stdout)
+    log.setLevel(logging.INFO)
+    
+    # 引数の検証（IP/CIDRの解析・妥当性チェック・正規化を同時に行う）
+    try:
         if delete:
-            print("エラー: --beforeと--afterオプション使用時は、--deleteオプションは使用できません。")
+            # 削除モード
+            if before or after:
+                log.error("エラー: --deleteオプション使用時は、--before、--afterオプションは使用できません。")
+                return
+            before_cidrs = parse_ip_list(delete)
+            after_cidrs = []
+            operation_mode = "削除"
+        elif before and after:
+            # IP変更モード
+            before_cidrs = parse_ip_list(before)
+            after_cidrs = parse_ip_list(after)
+            operation_mode = "IP変更"
+        else:
+            log.error("エラー: 以下のいずれかの形式で指定してください:")
+            log.error("  1. IP変更: --before <削除IP> --after <追加IP>")
+            log.error("  2. 削除: --delete <削除IP>")
             return
-        before_cidrs = parse_ip_list(before)
-        after_cidrs = parse_ip_list(after)
-        operation_mode = "IP変更"
-    else:
-        print("エラー: 以下のいずれかの形式で指定してください:")
-        print("  1. IP変更: --before <削除IP> --after <追加IP>")
-        print("  2. 削除: --delete <削除IP>")
+    except ValueError as e:
+        log.error(f"エラー: {e}")
+        return
+    
+    if operation_mode == "IP変更" and len(before_cidrs) != len(after_cidrs):
+        log.error("エラー: --beforeと--afterには同じ数のIP/CIDRを指定してください。")
         return
 
     config = load_config()
@@ -276,272 +745,189 @@ def main(before, after, delete, no_backup):
     sg_name = config["security_group_name"]
     waf_ipset_name = config["waf_ipset_name"]
 
-    # CIDR表記の妥当性チェック
-    invalid_before = [cidr for cidr in before_cidrs if not validate_cidr(cidr)]
-    invalid_after = [cidr for cidr in after_cidrs if not validate_cidr(cidr)]
+    # SG・WAFで共通の変更計画を作成
+    plan = build_change_plan(before_cidrs, after_cidrs)
     
-    if invalid_before:
-        print(f"エラー: 無効なCIDR表記（削除対象）: {invalid_before}")
-        return
+    if dry_run:
+        log.info(f"\n=== 変更計画（{operation_mode}・ドライラン） ===")
+        log.info(f"削除: {plan['remove'] or 'なし'}")
+        log.info(f"追加: {plan['add'] or 'なし'}")
+        for old, new in plan['mapping'].items():
+            log.info(f"  {old} -> {new}")
     
-    if invalid_after:
-        print(f"エラー: 無効なCIDR表記（追加対象）: {invalid_after}")
+    # 変更がない場合はAWSにアクセスせずに終了
+    if not plan['remove'] and not plan['add']:
+        log.info("変更対象がないため、処理を終了します。")
         return
 
-    # AWSクライアント
-    ec2 = boto3.client("ec2", region_name=region)
-    wafv2 = boto3.client("wafv2", region_name=region)
+    # AWSクライアント（Sessionを共有して認証情報の解決を1回にする）
+    session = boto3.session.Session(region_name=region)
+    ec2 = session.client("ec2", config=AWS_CLIENT_CONFIG)
+    wafv2 = session.client("wafv2", config=AWS_CLIENT_CONFIG)
 
     # セキュリティグループIDとWAF IPSet IDを取得
-    sg_id = get_security_group_id_by_name(ec2, sg_name)
-    waf_ipset_id = get_waf_ipset_id_by_name(wafv2, waf_ipset_name)
+    sg_id = get_security_group_id_by_name(ec2, sg_name, refresh_cache)
+    waf_ipset_id = get_waf_ipset_id_by_name(wafv2, waf_ipset_name, refresh_cache)
     
     sg_available = sg_id is not None
     waf_available = waf_ipset_id is not None
     
     if sg_available:
-        print(f"セキュリティグループID: {sg_id}")
+        log.info(f"セキュリティグループID: {sg_id}")
     else:
-        print(f"警告: セキュリティグループ '{sg_name}' が見つかりません")
+        log.warning(f"警告: セキュリティグループ '{sg_name}' が見つかりません")
     
     if waf_available:
-        print(f"WAF IPSet ID: {waf_ipset_id}")
+        log.info(f"WAF IPSet ID: {waf_ipset_id}")
     else:
-        print(f"警告: WAF IPSet '{waf_ipset_name}' が見つかりません")
+        log.warning(f"警告: WAF IPSet '{waf_ipset_name}' が見つかりません")
     
     # 両方とも見つからない場合はエラー
     if not sg_available and not waf_available:
-        print("エラー: セキュリティグループとWAF IPSetの両方が見つかりません。設定を確認してください。")
+        log.error("エラー: セキュリティグループとWAF IPSetの両方が見つかりません。設定を確認してください。")
         return
 
-    # SGの現在のIPを取得して、変更対象の存在確認
+    # SG・WAFの現在の状態を並列に取得して、変更対象の存在確認
+    # 取得結果はバックアップ・更新でも再利用する
+    sg = None
+    ipset = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        sg_future = executor.submit(fetch_security_group, ec2, sg_id, sg_name) if sg_available else None
+        waf_future = executor.submit(fetch_waf_ipset, wafv2, waf_ipset_name, waf_ipset_id) if waf_available else None
+
     sg_before_exists = {}
-    if sg_available:
+    if sg_future is not None:
         try:
-            sg_response = ec2.describe_security_groups(GroupIds=[sg_id])
-            sg = sg_response["SecurityGroups"][0]
-            
-            # 変更前IPの存在確認
-            for cidr in before_cidrs:
-                permissions = get_ip_permissions_for_cidr(sg["IpPermissions"], cidr)
-                sg_before_exists[cidr] = len(permissions) > 0
-        except Exception as e:
-            print(f"警告: セキュリティグループ情報取得エラー: {e}")
+            fetched_sg_id, sg = sg_future.result()
+            if fetched_sg_id is None:
+                sg_available = False
+                log.warning(f"警告: セキュリティグループ '{sg_name}' が見つかりません")
+            else:
+                if fetched_sg_id != sg_id:
+                    sg_id = fetched_sg_id
+                    log.info(f"セキュリティグループID（再取得）: {sg_id}")
+                
+                current_sg_ips = {
+                    canonicalize_cidr(ip_range['CidrIp'])
+                    for perm in sg["IpPermissions"]
+                    for ip_range in perm.get('IpRanges', [])
+                }
+                
+                # 変更前IPの存在確認
+                sg_before_exists = {cidr: cidr in current_sg_ips for cidr in before_cidrs}
+        except (BotoCoreError, ClientError) as e:
+            log.warning(f"警告: セキュリティグループ情報取得エラー: {e}")
 
-    # WAFの現在のIPを取得して、変更対象の存在確認
     waf_before_exists = {}
-    if waf_available:
+    waf_address_map = None
+    if waf_future is not None:
         try:
-            ipset = wafv2.get_ip_set(Name=waf_ipset_name, Id=waf_ipset_id, Scope="REGIONAL")
-            current_waf_ips = set(ipset["IPSet"]["Addresses"])
-            
-            # 変更前IPの存在確認
-            for cidr in before_cidrs:
-                waf_before_exists[cidr] = cidr in current_waf_ips
-        except Exception as e:
-            print(f"警告: WAF IPSet情報取得エラー: {e}")
-
-    # 実行前の確認
-    print(f"\n=== {operation_mode}の確認 ===")
-    if not confirm_execution(before_cidrs, after_cidrs, sg_name, waf_ipset_name, sg_available, waf_available, sg_before_exists, waf_before_exists):
-        print("実行をキャンセルしました。")
+            fetched_waf_ipset_id, ipset = waf_future.result()
+            if fetched_waf_ipset_id is None:
+                waf_available = False
+                log.warning(f"警告: WAF IPSet '{waf_ipset_name}' が見つかりません")
+            else:
+                if fetched_waf_ipset_id != waf_ipset_id:
+                    waf_ipset_id = fetched_waf_ipset_id
+                    log.info(f"WAF IPSet ID（再取得）: {waf_ipset_id}")
+                # 正規形の対応はここで1回だけ作成し、更新・一覧表示でも再利用する
+                waf_address_map = build_address_map(ipset["IPSet"]["Addresses"])
+                
+                # 変更前IPの存在確認
+                waf_before_exists = {cidr: cidr in waf_address_map for cidr in before_cidrs}
+        except (BotoCoreError, ClientError) as e:
+            log.warning(f"警告: WAF IPSet情報取得エラー: {e}")
+
+    # 削除対象のIPがSG・WAFのどちらにも存在しなければ何も変更されないため、確認・バックアップの前に終了する
+    # （事前確認で状態を取得できなかった場合は判定できないため続行する）
+    sg_has_targets = sg_available and (not sg_before_exists or any(sg_before_exists[cidr] for cidr in plan['remove']))
+    waf_has_targets = waf_available and (not waf_before_exists or any(waf_before_exists[cidr] for cidr in plan['remove']))
+    if not sg_has_targets and not waf_has_targets:
+        log.info("変更対象のIPがSG・WAFのいずれにも存在しないため、処理を終了します。")
+        return
+
+    # 実行前の確認（ドライランでは確認内容の表示のみ行い、プロンプトは出さない）
+    log.info(f"\n=== {operation_mode}の確認 ===")
+    if not confirm_execution(before_cidrs, after_cidrs, sg_name, waf_ipset_name, sg_available, waf_available, sg_before_exists, waf_before_exists, assume_yes or dry_run):
+        log.info("実行をキャンセルしました。")
         return
 
     # --- バックアップ実行 ---
-    print("\n=== バックアップ実行 ===")
-    backup_dir = create_backup_directory()
-    
-    sg_backup_path = None
-    waf_backup_path = None
-    
-    if sg_available:
-        print(f"[SG] {sg_name} のバックアップを作成中...")
-        sg_backup_path = backup_security_group_to_csv(ec2, sg_id, sg_name, backup_dir)
-    else:
-        print(f"[SG] {sg_name} のバックアップをスキップします（見つかりません）")
-    
-    if waf_available:
-        print(f"[WAF] {waf_ipset_name} のバックアップを作成中...")
-        waf_backup_path = backup_waf_ipset_to_csv(wafv2, waf_ipset_name, waf_ipset_id, backup_dir)
+    if dry_run:
+        log.info("\nドライランのため、バックアップを省略します")
     else:
-        print(f"[WAF] {waf_ipset_name} のバックアップをスキップします（見つかりません）")
-    
-    # バックアップサマリーを作成
-    create_backup_summary(backup_dir, sg_backup_path, waf_backup_path, sg_name, waf_ipset_name)
-    print("バックアップ完了")
+        create_backups(ec2, wafv2, sg_id, sg_name, waf_ipset_id, waf_ipset_name, sg_available, waf_available, sg, ipset)
 
-    print("\n変更を実行します...")
+    log.info("\n変更内容を確認します（ドライラン）..." if dry_run else "\n変更を実行します...")
 
-    # 変更対象のIPを記録（後で目印表示用）
-    changed_ips = set()
-    for cidr in before_cidrs:
-        changed_ips.add(cidr)
-    for cidr in after_cidrs:
-        changed_ips.add(cidr)
+    # 変更対象のIPを正規形で記録（後で目印表示用）
+    changed_ips = frozenset(map(canonicalize_cidr, itertools.chain(before_cidrs, after_cidrs)))
 
-    # --- セキュリティグループ更新 ---
-    if sg_available:
-        print(f"\n[SG] {sg_name} ({sg_id}) の許可IPを更新します")
-        
-        # 現在のSG情報を取得
-        sg_response = ec2.describe_security_groups(GroupIds=[sg_id])
-        sg = sg_response["SecurityGroups"][0]
-        
-        if operation_mode == "削除":
-            # 削除モード: 既存の権限を削除
-            try:
-                # 変更前CIDRのすべての権限を削除
-                for cidr in before_cidrs:
-                    permissions_to_remove = get_ip_permissions_for_cidr(sg["IpPermissions"], cidr)
-                    
-                    if permissions_to_remove:
-                        # 権限を削除
-                        ec2.revoke_security_group_ingress(
-                            GroupId=sg_id,
-                            IpPermissions=permissions_to_remove
-                        )
-                        print(f"  削除: {cidr} (プロトコル: {len(permissions_to_remove)}個)")
-                    else:
-                        print(f"  削除対象なし: {cidr}")
-                    
-            except Exception as e:
-                print(f"  削除失敗: {e}")
-        
+    # --- セキュリティグループ・WAF IPSet更新 ---
+    # 両者は独立しているため並列に実行し、出力はそれぞれバッファして順番に表示する
+    sg_output = []
+    waf_output = []
+    # 更新後の状態を保持し、一覧表示時の再取得を省略する
+    sg_permissions = None
+    waf_addresses = None
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        sg_future = None
+        waf_future = None
+        if sg_available:
+            sg_future = executor.submit(
+                update_security_group, ec2, sg_id, sg_name, operation_mode,
+                plan, sg_output, sg, dry_run
+            )
+        if waf_available:
+            waf_future = executor.submit(
+                update_waf_ipset, wafv2, waf_ipset_name, waf_ipset_id, operation_mode,
+                plan, waf_output, ipset, waf_address_map, dry_run
+            )
+        concurrent.futures.wait([f for f in (sg_future, waf_future) if f is not None])
+    
+    if sg_future is not None:
+        log_buffered(sg_output)
+        if sg_future.exception() is None:
+            sg_permissions = sg_future.result()
         else:
-            # IP変更モード: 既存の処理
-            # 変更対象のIPを特定
-            sg_before_targets = [cidr for cidr in before_cidrs if sg_before_exists.get(cidr, False)]
-            
-            if not sg_before_targets:
-                print("  変更対象が存在しません")
-            else:
-                # 1. 変更前CIDRのすべての権限を削除
-                for cidr in sg_before_targets:
-                    try:
-                        # 指定CIDRに関連するすべての権限を取得
-                        permissions_to_remove = get_ip_permissions_for_cidr(sg["IpPermissions"], cidr)
-                        
-                        if permissions_to_remove:
-                            # 権限を削除
-                            ec2.revoke_security_group_ingress(
-                                GroupId=sg_id,
-                                IpPermissions=permissions_to_remove
-                            )
-                            print(f"  削除: {cidr} (プロトコル: {len(permissions_to_remove)}個)")
-                        
-                    except Exception as e:
-                        print(f"  削除失敗: {cidr} ({e})")
-                
-                # 2. 変更後CIDRを追加（削除した権限と同じ権限を新しいCIDRで追加）
-                for cidr in after_cidrs:
-                    try:
-                        # 削除された権限と同じ権限を新しいCIDRで作成
-                        permissions_to_add = []
-                        
-                        # 削除された権限をベースに新しいCIDR用の権限を作成
-                        for removed_cidr in sg_before_targets:
-                            removed_permissions = get_ip_permissions_for_cidr(sg["IpPermissions"], removed_cidr)
-                            for perm in removed_permissions:
-                                new_perm = perm.copy()
-                                new_perm['IpRanges'] = []
-                                
-                                # 新しいCIDR用のIPRangeを作成（元のDescriptionを保持）
-                                for ip_range in perm.get('IpRanges', []):
-                                    if ip_range['CidrIp'] == removed_cidr:
-                                        new_perm['IpRanges'].append({
-                                            'CidrIp': cidr,
-                                            'Description': ip_range.get('Description', '')  # 元のDescriptionをそのまま使用
-                                        })
-                                    else:
-                                        new_perm['IpRanges'].append(ip_range)
-                                
-                                permissions_to_add.append(new_perm)
-                        
-                        # 権限を追加
-                        if permissions_to_add:
-                            ec2.authorize_security_group_ingress(
-                                GroupId=sg_id,
-                                IpPermissions=permissions_to_add
-                            )
-                            print(f"  追加: {cidr} (プロトコル: {len(permissions_to_add)}個)")
-                        
-                    except Exception as e:
-                        print(f"  追加失敗: {cidr} ({e})")
+            log.error(f"  SG更新失敗: {sg_future.exception()}")
     else:
-        print(f"\n[SG] {sg_name} の更新をスキップします（見つかりません）")
-
-    # --- WAF IPSet更新 ---
-    if waf_available:
-        print(f"\n[WAF] {waf_ipset_name} ({waf_ipset_id}) のIPSetを更新します")
-        
-        if operation_mode == "削除":
-            # 削除モード: 既存のIPを削除
-            try:
-                ipset = wafv2.get_ip_set(Name=waf_ipset_name, Id=waf_ipset_id, Scope="REGIONAL")
-                addresses = set(ipset["IPSet"]["Addresses"])
-                
-                # 変更前CIDRを削除
-                for cidr in before_cidrs:
-                    addresses.discard(cidr)
-                    print(f"  削除: {cidr}")
-                
-                # 反映
-                wafv2.update_ip_set(
-                    Name=waf_ipset_name,
-                    Id=waf_ipset_id,
-                    Scope="REGIONAL",
-                    Addresses=list(addresses),
-                    LockToken=ipset["LockToken"]
-                )
-                print(f"  許可IPセット: {sorted(addresses)}")
-            except Exception as e:
-                print(f"  WAF削除失敗: {e}")
-        
+        log.info(f"\n[SG] {sg_name} の更新をスキップします（見つかりません）")
+    
+    if waf_future is not None:
+        log_buffered(waf_output)
+        if waf_future.exception() is None:
+            waf_addresses, waf_address_map = waf_future.result()
         else:
-            # IP変更モード: 既存の処理
-            # WAFで実際に変更が必要なIPを特定
-            waf_before_targets = [cidr for cidr in before_cidrs if waf_before_exists.get(cidr, False)]
-            
-            if not waf_before_targets:
-                print("  変更対象が存在しません")
-            else:
-                try:
-                    ipset = wafv2.get_ip_set(Name=waf_ipset_name, Id=waf_ipset_id, Scope="REGIONAL")
-                    addresses = set(ipset["IPSet"]["Addresses"])
-                    
-                    # 1. 変更前CIDRを削除（存在する場合のみ）
-                    for cidr in waf_before_targets:
-                        addresses.discard(cidr)
-                        print(f"  削除: {cidr}")
-                    
-                    # 2. 変更後CIDRを追加（存在する場合のみ）
-                    for cidr in after_cidrs:
-                        addresses.add(cidr)
-                        print(f"  追加: {cidr}")
-                    
-                    # 3. 反映
-                    wafv2.update_ip_set(
-                        Name=waf_ipset_name,
-                        Id=waf_ipset_id,
-                        Scope="REGIONAL",
-                        Addresses=list(addresses),
-                        LockToken=ipset["LockToken"]
-                    )
-                    print(f"  許可IPセット: {sorted(addresses)}")
-                except Exception as e:
-                    print(f"  WAF更新失敗: {e}")
+            log.error(f"  WAF更新失敗: {waf_future.exception()}")
     else:
-        print(f"\n[WAF] {waf_ipset_name} の更新をスキップします（見つかりません）")
+        log.info(f"\n[WAF] {waf_ipset_name} の更新をスキップします（見つかりません）")
+
+    if dry_run:
+        log.info("\nドライランのため、変更は行っていません。")
+        return
 
     # --- 現在の許可IP一覧を出力 ---
-    print("\n=== 現在の許可IP一覧 ===")
+    # 行数が多くなるため、まとめて1回で出力する
+    lines = [(logging.INFO, "\n=== 現在の許可IP一覧 ===")]
+    
+    # 更新結果を使えない場合のみ、現在の状態を並列に取得
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        sg_future = None
+        waf_future = None
+        if sg_available and sg_permissions is None:
+            sg_future = executor.submit(ec2.describe_security_groups, GroupIds=[sg_id])
+        if waf_available and waf_addresses is None:
+            waf_future = executor.submit(wafv2.get_ip_set, Name=waf_ipset_name, Id=waf_ipset_id, Scope="REGIONAL")
     
     # SG
     if sg_available:
         try:
-            sg = ec2.describe_security_groups(GroupIds=[sg_id])["SecurityGroups"][0]
-            print(f"[SG] {sg_name}")
-            for perm in sg["IpPermissions"]:
+            if sg_permissions is None:
+                sg_permissions = sg_future.result()["SecurityGroups"][0]["IpPermissions"]
+            lines.append((logging.INFO, f"[SG] {sg_name}"))
+            for perm in sg_permissions:
                 if perm.get('IpRanges'):
                     for ip_range in perm.get('IpRanges', []):
                         protocol = perm.get('IpProtocol', 'all')
@@ -551,38 +937,44 @@ def main(before, after, delete, no_backup):
                         description = ip_range.get('Description', '')
                         
                         # 変更対象のIPに目印をつける
-                        if cidr in changed_ips:
+                        if canonicalize_cidr(cidr) in changed_ips:
                             marker = " [変更対象]"
                         else:
                             marker = ""
                         
                         if description:
-                            print(f"  {protocol} {from_port}-{to_port}: {cidr} ({description}){marker}")
+                            lines.append((logging.INFO, f"  {protocol} {from_port}-{to_port}: {cidr} ({description}){marker}"))
                         else:
-                            print(f"  {protocol} {from_port}-{to_port}: {cidr}{marker}")
-        except Exception as e:
-            print(f"[SG] {sg_name} の状態取得に失敗: {e}")
+                            lines.append((logging.INFO, f"  {protocol} {from_port}-{to_port}: {cidr}{marker}"))
+        except (BotoCoreError, ClientError) as e:
+            lines.append((logging.ERROR, f"[SG] {sg_name} の状態取得に失敗: {e}"))
     else:
-        print(f"[SG] {sg_name} - 利用不可")
+        lines.append((logging.INFO, f"[SG] {sg_name} - 利用不可"))
     
     # WAF
     if waf_available:
         try:
-            ipset = wafv2.get_ip_set(Name=waf_ipset_name, Id=waf_ipset_id, Scope="REGIONAL")
-            print(f"[WAF] {waf_ipset_name}")
-            for ip in sorted(ipset["IPSet"]["Addresses"]):
+            if waf_addresses is None:
+                waf_address_map = build_address_map(waf_future.result()["IPSet"]["Addresses"])
+                waf_addresses = sorted(waf_address_map.values())
+            # 変更対象のIPをAWS上の表記に変換しておき、アドレスごとの解析を省く
+            changed_waf_ips = {waf_address_map[cidr] for cidr in changed_ips if cidr in waf_address_map}
+            lines.append((logging.INFO, f"[WAF] {waf_ipset_name}"))
+            for ip in waf_addresses:
                 # 変更対象のIPに目印をつける
-                if ip in changed_ips:
+                if ip in changed_waf_ips:
                     marker = " [変更対象]"
                 else:
                     marker = ""
-                print(f"  {ip}{marker}")
-        except Exception as e:
-            print(f"[WAF] {waf_ipset_name} の状態取得に失敗: {e}")
+                lines.append((logging.INFO, f"  {ip}{marker}"))
+        except (BotoCoreError, ClientError) as e:
+            lines.append((logging.ERROR, f"[WAF] {waf_ipset_name} の状態取得に失敗: {e}"))
     else:
-        print(f"[WAF] {waf_ipset_name} - 利用不可")
+        lines.append((logging.INFO, f"[WAF] {waf_ipset_name} - 利用不可"))
+    
+    log_buffered(lines)
 
-    print("\n処理が完了しました。")
+    log.info("\n処理が完了しました。")
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file